@@ -0,0 +1,429 @@
+"""
+Load-testing harness for the nginx configuration generated by Shogun.
+
+Generates a shogun.conf for a number of synthetic students using NginxConfig, starts lightweight stand-in HTTP backends
+on the target ports, runs a local nginx with the generated config and drives concurrent requests with varied Host
+headers. Reports throughput, latency percentiles and nginx memory usage. No Docker containers are needed.
+
+Example:
+    python src/benchmark.py --lab musashi-js --students 300 --requests 50000 --concurrency 200
+"""
+import argparse
+import asyncio
+import contextlib
+import grp
+import io
+import json
+import multiprocessing
+import os
+import pwd
+import random
+import resource
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+
+from certificate_providers import SelfSignedProvider
+from lab_config import config
+from nginx import NginxConfig, CUSTOM_HEADER_VALUE
+
+
+def positive_int(value):
+    """
+    Argparse type for counts that must be at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def raise_open_file_limit():
+    """
+    Raise the soft limit on open files to the hard limit. Every backend port and connection uses a file descriptor.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def generate_config(work_dir, lab_id, students, listen_port, backend_port, use_features=True, tls=False):
+    """
+    Generate a shogun.conf with a server block for each route of each synthetic student.
+
+    :param work_dir: The directory to write the config to
+    :param lab_id: The ID of the lab in the config file whose routes and features are used
+    :param students: The number of synthetic students
+    :param listen_port: The port the server blocks listen on
+    :param backend_port: The first backend port. Each route gets its own port.
+    :param use_features: Whether to apply the lab's features to the generated server blocks
+    :param tls: Whether to serve HTTPS on the listen port, using self-signed per-lab wildcard certificates and the TLS
+                profile from the config file
+    :return: The NginxConfig object and a list of the backend ports
+    """
+    lab_config = next((lab for lab in config['labs'] if lab['name'] == lab_id), None)
+    if lab_config is None:
+        raise ValueError(f"Could not find lab with id {lab_id}")
+
+    domain = config.get('domain', 'example.com')
+    features = lab_config.get('features', {}) if use_features else {}
+    nginx = NginxConfig(os.path.join(work_dir, 'shogun.conf'), cache_dir=os.path.join(work_dir, 'cache'))
+
+    port = backend_port
+    # add_server prints every route it adds, which isn't useful for thousands of synthetic routes
+    with contextlib.redirect_stdout(io.StringIO()):
+        for idx in range(1, students + 1):
+            for subdomain in lab_config.get('subdomain_routes', {}):
+                nginx.add_server(f"bench{idx}", lab_id, subdomain, domain, port, listen_ports=[listen_port],
+                                 features=features)
+                port += 1
+
+        if tls:
+            # use the self-signed provider with the certificates kept in the work dir
+            certificate_provider = SelfSignedProvider()
+            certificate_provider.cert_dir = work_dir
+            nginx.certificate_provider = certificate_provider
+            for server in nginx.servers:
+                server.certificate_provider = certificate_provider
+                server.https_port = listen_port
+        nginx.save()
+
+    if port > 65535:
+        raise ValueError(f"Not enough ports for {port - backend_port} routes starting at {backend_port}")
+    return nginx, list(range(backend_port, port))
+
+
+def write_nginx_conf(work_dir, workers, connections, server_count):
+    """
+    Write a standalone nginx.conf that includes the generated shogun.conf and keeps all state inside work_dir.
+    """
+    hash_max_size = max(512, 1 << (server_count * 2 - 1).bit_length())
+
+    # When started as root, nginx runs its workers as nobody, which can't write to the cache and temp directories in
+    # the (0700) work dir. Run the workers as the current user instead. The directive is ignored for other users.
+    user_directive = ""
+    if os.geteuid() == 0:
+        user_directive = f"user {pwd.getpwuid(os.geteuid()).pw_name} {grp.getgrgid(os.getegid()).gr_name};\n"
+
+    nginx_conf_path = os.path.join(work_dir, 'nginx.conf')
+    with open(nginx_conf_path, 'w') as file:
+        file.write(f"""{user_directive}worker_processes {workers};
+pid {work_dir}/nginx.pid;
+error_log {work_dir}/error.log warn;
+
+events {{
+    worker_connections {connections};
+}}
+
+http {{
+    access_log off;
+    client_body_temp_path {work_dir}/client_body_temp;
+    proxy_temp_path {work_dir}/proxy_temp;
+    fastcgi_temp_path {work_dir}/fastcgi_temp;
+    uwsgi_temp_path {work_dir}/uwsgi_temp;
+    scgi_temp_path {work_dir}/scgi_temp;
+    keepalive_timeout 65;
+    server_names_hash_bucket_size 128;
+    server_names_hash_max_size {hash_max_size};
+
+    include {work_dir}/shogun.conf;
+}}
+""")
+    return nginx_conf_path
+
+
+async def handle_backend_connection(reader, writer, body):
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            request_line, _, headers = head.decode('latin-1').partition('\r\n')
+            path = request_line.split(' ')[1] if ' ' in request_line else '/'
+            content_type = 'application/javascript' if path.endswith('.js') else 'text/html'
+            keep_alive = request_line.endswith('HTTP/1.1') and 'connection: close' not in headers.lower()
+
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_backends(ports, body_size):
+    """
+    Run a minimal HTTP server on each port until the process is terminated. Used as a stand-in for lab containers.
+    """
+    raise_open_file_limit()
+    body = b'x' * body_size
+
+    async def serve():
+        for port in ports:
+            await asyncio.start_server(lambda r, w: handle_backend_connection(r, w, body), '127.0.0.1', port,
+                                       backlog=1024)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def read_response(reader):
+    """
+    Read a single HTTP/1.1 response and return its status code and whether the connection can be reused.
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    status_line, _, raw_headers = head.decode('latin-1').partition('\r\n')
+    status = int(status_line.split(' ')[1])
+    headers = {}
+    for line in raw_headers.strip().split('\r\n'):
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+
+    return status, headers.get('connection') != 'close'
+
+
+async def drive_load(listen_port, hosts, paths, requests, concurrency, tls=False, connection_requests=0):
+    """
+    Send requests to nginx over concurrent keep-alive connections, picking a random host and path for every request.
+
+    :param tls: Connect with TLS. Certificates aren't verified and every connection makes a full handshake.
+    :param connection_requests: The number of requests to send per connection before reconnecting (0 for unlimited)
+
+    :return: A list of latencies in seconds, a dictionary of status code counts and the number of failed requests
+    """
+    latencies = []
+    statuses = {}
+    errors = 0
+    remaining = requests
+    extra_headers = f"X-SAMURAIWTF: {CUSTOM_HEADER_VALUE}\r\n" if CUSTOM_HEADER_VALUE else ""
+
+    ssl_context = None
+    if tls:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def worker():
+        nonlocal remaining, errors
+        connection = None
+        connection_count = 0
+        while remaining > 0:
+            remaining -= 1
+            host = random.choice(hosts)
+            request = (f"GET {random.choice(paths)} HTTP/1.1\r\nHost: {host}\r\n"
+                       f"Accept-Encoding: gzip\r\n{extra_headers}\r\n").encode('latin-1')
+            start = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = await asyncio.open_connection('127.0.0.1', listen_port, ssl=ssl_context,
+                                                               server_hostname=host if tls else None)
+                    connection_count = 0
+                reader, writer = connection
+                writer.write(request)
+                status, keep_alive = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors += 1
+                connection = None
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            connection_count += 1
+            if not keep_alive or connection_count == connection_requests:
+                writer.close()
+                connection = None
+        if connection:
+            connection[1].close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, errors
+
+
+def run_load(args):
+    raise_open_file_limit()
+    return asyncio.run(drive_load(*args))
+
+
+def get_nginx_memory(master_pid):
+    """
+    Return the memory used by the nginx master and worker processes in KiB. Uses the proportional set size when
+    available so that memory shared between workers isn't counted more than once.
+    """
+    pids = [master_pid]
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f"/proc/{pid}/stat") as file:
+                if int(file.read().rsplit(')', 1)[1].split()[1]) == master_pid:
+                    pids.append(int(pid))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total = 0
+    for pid in pids:
+        try:
+            if os.path.exists(f"/proc/{pid}/smaps_rollup"):
+                path, field = f"/proc/{pid}/smaps_rollup", 'Pss:'
+            else:
+                path, field = f"/proc/{pid}/status", 'VmRSS:'
+            with open(path) as file:
+                total += next(int(line.split()[1]) for line in file if line.startswith(field))
+        except (OSError, StopIteration):
+            continue
+    return total
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise Exception(f"Timed out waiting for port {port}")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def run_benchmark(args):
+    raise_open_file_limit()
+    # nginx resolves relative paths in the config against its prefix, so all generated paths must be absolute
+    work_dir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='shogun-bench-')
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    nginx_process = None
+    backend_process = None
+
+    try:
+        nginx_config, backend_ports = generate_config(work_dir, args.lab, args.students, args.listen_port,
+                                                      args.backend_port, not args.no_features, args.tls)
+        nginx_conf_path = write_nginx_conf(work_dir, args.workers, args.worker_connections,
+                                           len(nginx_config.servers))
+
+        backend_process = multiprocessing.Process(target=run_backends, args=(backend_ports, args.body_size),
+                                                  daemon=True)
+        backend_process.start()
+        wait_for_port(backend_ports[-1])
+
+        nginx_command = [args.nginx, '-p', work_dir, '-c', nginx_conf_path]
+        subprocess.run(nginx_command + ['-t', '-q'], check=True)
+        nginx_process = subprocess.Popen(nginx_command + ['-g', 'daemon off;'])
+        wait_for_port(args.listen_port)
+        idle_memory = get_nginx_memory(nginx_process.pid)
+
+        hosts = [server.name for server in nginx_config.servers]
+        process_count = min(args.processes, args.concurrency)
+        # split the requests and connections evenly between the load generator processes
+        jobs = [(args.listen_port, hosts, args.paths,
+                 args.requests // process_count + (idx < args.requests % process_count),
+                 args.concurrency // process_count + (idx < args.concurrency % process_count),
+                 args.tls, args.connection_requests)
+                for idx in range(process_count)]
+
+        peak_memory = idle_memory
+        start = time.perf_counter()
+        with multiprocessing.Pool(process_count) as pool:
+            result = pool.map_async(run_load, jobs)
+            while not result.ready():
+                peak_memory = max(peak_memory, get_nginx_memory(nginx_process.pid))
+                result.wait(0.5)
+            results = result.get()
+        duration = time.perf_counter() - start
+
+        latencies = sorted(latency for job_latencies, _, _ in results for latency in job_latencies)
+        statuses = {}
+        for _, job_statuses, _ in results:
+            for status, count in job_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+        return {
+            'lab': args.lab,
+            'students': args.students,
+            'routes': len(nginx_config.servers),
+            'features': not args.no_features,
+            'tls': args.tls,
+            'config_bytes': os.path.getsize(nginx_config.config_path),
+            'requests': len(latencies),
+            'errors': sum(job_errors for _, _, job_errors in results),
+            'statuses': statuses,
+            'duration_s': round(duration, 3),
+            'throughput_rps': round(len(latencies) / duration, 1) if duration else 0,
+            'latency_ms': {name: round(percentile(latencies, pct) * 1000, 2)
+                           for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))},
+            'nginx_memory_kib': {'idle': idle_memory, 'peak': peak_memory},
+        }
+    finally:
+        if nginx_process:
+            nginx_process.terminate()
+            nginx_process.wait()
+        if backend_process:
+            backend_process.terminate()
+        if args.keep or args.workdir:
+            print(f"Benchmark files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report):
+    print(f"Lab {report['lab']}: {report['students']} students, {report['routes']} routes, "
+          f"features {'on' if report['features'] else 'off'}, tls {'on' if report['tls'] else 'off'}, "
+          f"config {report['config_bytes']} bytes")
+    print(f"Requests:   {report['requests']} in {report['duration_s']}s ({report['throughput_rps']} req/s), "
+          f"{report['errors']} errors")
+    print(f"Statuses:   {', '.join(f'{status}: {count}' for status, count in sorted(report['statuses'].items()))}")
+    print(f"Latency:    {', '.join(f'{name} {value} ms' for name, value in report['latency_ms'].items())}")
+    print(f"Nginx mem:  idle {report['nginx_memory_kib']['idle']} KiB, peak {report['nginx_memory_kib']['peak']} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the nginx config generated by Shogun')
+    parser.add_argument('--lab', default='musashi-js', help='Lab ID whose routes and features are used')
+    parser.add_argument('--students', type=positive_int, default=100, help='Number of synthetic students')
+    parser.add_argument('--requests', type=positive_int, default=20000, help='Total number of requests to send')
+    parser.add_argument('--concurrency', type=positive_int, default=100, help='Number of concurrent client connections')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='Number of load generator processes (default: number of CPUs)')
+    parser.add_argument('--paths', nargs='+', default=['/', '/main.js'], help='Request paths to choose from')
+    parser.add_argument('--body-size', type=int, default=4096, help='Size of the backend response bodies in bytes')
+    parser.add_argument('--no-features', action='store_true', default=False,
+                        help='Generate the config without the lab features (e.g. to compare caching on and off)')
+    parser.add_argument('--tls', action='store_true', default=False,
+                        help='Serve HTTPS with self-signed certificates and the TLS profile from the config file. The '
+                             'client uses HTTP/1.1 without session resumption.')
+    parser.add_argument('--connection-requests', type=int, default=0,
+                        help='Requests per client connection before reconnecting, e.g. 1 to measure TLS handshakes '
+                             '(default: 0, unlimited)')
+    parser.add_argument('--nginx', default='nginx', help='Path to the nginx binary')
+    parser.add_argument('--workers', default='auto', help='nginx worker_processes setting')
+    parser.add_argument('--worker-connections', type=int, default=4096, help='nginx worker_connections setting')
+    parser.add_argument('--listen-port', type=int, default=18080, help='Port nginx listens on')
+    parser.add_argument('--backend-port', type=int, default=20000, help='First port used by the stand-in backends')
+    parser.add_argument('--workdir', help='Directory for the generated config and nginx state (kept after the run)')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keep the temporary benchmark directory')
+    parser.add_argument('--format', choices=['json', 'text'], default='text',
+                        help='Output format: text or json (default: text)')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.format == 'json':
+        print(json.dumps(report))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
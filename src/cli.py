@@ -5,6 +5,7 @@ import time
 
 from compose import create_student_container, delete_student_container, list_available_labs, \
     list_student_lab_combinations, multi_create_student_container
+from garbage_collector import collect_garbage, DEFAULT_GRACE_MINUTES
 from lab_config import config
 
 
@@ -58,6 +59,19 @@ def main():
     reload_parser.add_argument('--pause', type=int, default=8,
                                help='Pause duration between delete and create operations (in seconds)')
 
+    gc_parser = subparsers.add_parser('gc', help='Remove orphaned lab resources')
+    gc_parser.add_argument('--dry-run', action='store_true', default=False,
+                           help='List orphaned resources without removing them')
+    gc_parser.add_argument('--workers', type=int, default=8,
+                           help='Number of resources to remove in parallel (default: 8)')
+    gc_parser.add_argument('--dangling', action='store_true', default=False,
+                           help='Also remove dangling anonymous volumes, including ones not created by Shogun')
+    gc_parser.add_argument('--grace', type=int, default=DEFAULT_GRACE_MINUTES,
+                           help='Keep resources created less than this many minutes ago, which may belong to labs '
+                                f'that are still being created (default: {DEFAULT_GRACE_MINUTES})')
+    gc_parser.add_argument('--norestart', action='store_true', default=False,
+                           help='Do not restart Nginx after removing stale routes (default: restart)')
+
     args = parser.parse_args()
 
     if args.command == 'create':
@@ -120,6 +134,13 @@ def main():
 
     elif args.command == 'reload':
         reload_containers(args.pause)
+    elif args.command == 'gc':
+        orphans = collect_garbage(args.dry_run, args.workers, args.norestart, args.dangling, args.grace)
+        orphan_count = sum(len(type_orphans) for type_orphans in orphans.values())
+        if orphan_count == 0:
+            print("No orphaned resources found.")
+        elif args.dry_run:
+            print(f"Found {orphan_count} orphaned resources. Run without --dry-run to remove them.")
     else:
         parser.print_help()
 
@@ -1,3 +1,5 @@
+import ipaddress
+import json
 import os
 import subprocess
 import yaml
@@ -7,11 +9,35 @@ from lab_config import config
 from fnmatch import fnmatch
 import docker
 from jinja2 import Template
+from shared_services import load_shared_services
 
 client = docker.from_env()
 os.makedirs('tmp', exist_ok=True)
 nginx = NginxConfig()  # create nginx config object to manage lab server blocks
 
+# Networking mode for lab services. In "host" mode (the default) each route publishes a host port that nginx proxies to.
+# In "shared" mode lab services join a shared bridge network and nginx proxies to the containers directly, so no host
+# ports are allocated. The route target is either the container IP ("ip", for nginx running on the host) or a network
+# alias ("name", for nginx running in a container attached to the same network).
+network_config = config.get('network') or {}
+NETWORK_MODE = network_config.get('mode', 'host')
+SHARED_NETWORK_NAME = network_config.get('name', 'shogun')
+SHARED_NETWORK_TARGET = network_config.get('target', 'ip')
+
+# Subnet of the shared network. Docker assigns addresses from the dynamic range, and routed services get a fixed
+# address from the rest of the subnet so that their IP doesn't change when the docker daemon or the host restarts.
+# The default is outside docker's default address pools, which the labs' project networks are allocated from.
+SHARED_NETWORK_SUBNET = network_config.get('subnet', '10.201.0.0/16')
+SHARED_NETWORK_DYNAMIC_RANGE = network_config.get('dynamic_range', '10.201.0.0/24')
+
+# First placeholder port used to render port variables in shared mode
+PLACEHOLDER_PORT_START = 60000
+
+if NETWORK_MODE not in ('host', 'shared'):
+    raise ValueError(f"Unsupported network mode: {NETWORK_MODE}")
+if SHARED_NETWORK_TARGET not in ('ip', 'name'):
+    raise ValueError(f"Unsupported network target: {SHARED_NETWORK_TARGET}")
+
 
 def create_student_container(student_id, lab_id, norestart=False, save=True, template=None):
     # get the domain from the config file
@@ -59,7 +85,24 @@ def create_student_container(student_id, lab_id, norestart=False, save=True, tem
 
     subdomain_routes = lab_config.get('subdomain_routes', {})
 
-    available_ports = get_available_ports(8000, 9000, len(subdomain_routes), exclude=nginx.get_in_use_ports())
+    # Shared services run once per lab on the lab's shared services network. Each student gets their own tenant, and
+    # the connection details are passed to the student's services as template variables.
+    shared_services_network = get_shared_services_network(lab_id)
+    shared_services = load_shared_services(client, lab_id, lab_config, shared_services_network)
+    if shared_services:
+        ensure_shared_services_network(lab_id)
+    shared_variables = {}
+    for shared_service in shared_services:
+        shared_service.ensure_running()
+        shared_variables.update(shared_service.provision(student_id))
+    compose_variables.update(shared_variables)
+
+    if NETWORK_MODE == 'shared':
+        # No host ports are published in shared mode. The port variables are rendered with placeholder values that are
+        # only used to find the matching port mappings in the rendered compose file.
+        available_ports = list(range(PLACEHOLDER_PORT_START, PLACEHOLDER_PORT_START + len(subdomain_routes)))
+    else:
+        available_ports = get_available_ports(8000, 9000, len(subdomain_routes), exclude=nginx.get_in_use_ports())
 
     # cache subdomain to port mapping. Ports will be assigned from available ports.
     subdomain_port_mapping = {}
@@ -73,6 +116,13 @@ def create_student_container(student_id, lab_id, norestart=False, save=True, tem
     compose_config_string = template.render(**compose_variables)
     compose_config = yaml.safe_load(compose_config_string)
 
+    route_services = {}
+    if NETWORK_MODE == 'shared':
+        ensure_shared_network()
+        route_services = attach_shared_network(compose_config, container_name, subdomain_port_mapping.values())
+    if shared_services:
+        attach_shared_services_network(compose_config, shared_services_network, shared_variables)
+
     with open(tmp_file_path, 'w') as file:
         yaml.dump(compose_config, file)
 
@@ -86,13 +136,168 @@ def create_student_container(student_id, lab_id, norestart=False, save=True, tem
     # add nginx server blocks for each subdomain
     # signature for add_server is: add_server(self, student_id, lab_id, subdomain, domain, target_port)
     for subdomain, port in subdomain_port_mapping.items():
-        nginx.add_server(student_id, lab_id, subdomain, domain, port, features=lab_config.get('features', {}))
+        target_ip, target_port = '127.0.0.1', port
+        if NETWORK_MODE == 'shared':
+            target_port, target_ip = route_services[port]
+        nginx.add_server(student_id, lab_id, subdomain, domain, target_port, target_ip=target_ip,
+                         features=lab_config.get('features', {}))
 
     if save:
         nginx.save()
     nginx.reload(norestart=norestart)
 
 
+def ensure_shared_network():
+    """
+    Creates the shared bridge network used in shared networking mode if it doesn't already exist.
+    """
+    if not network_exists(SHARED_NETWORK_NAME):
+        print(f"Creating shared network {SHARED_NETWORK_NAME}")
+        # Nginx on the host still reaches the containers through the bridge when inter-container communication is
+        # disabled, so students' containers can't reach each other. Nginx in a container needs it enabled.
+        options = {'com.docker.network.bridge.enable_icc': 'false'} if SHARED_NETWORK_TARGET == 'ip' else {}
+        ipam = docker.types.IPAMConfig(pool_configs=[docker.types.IPAMPool(subnet=SHARED_NETWORK_SUBNET,
+                                                                           iprange=SHARED_NETWORK_DYNAMIC_RANGE)])
+        client.networks.create(SHARED_NETWORK_NAME, driver='bridge', options=options, ipam=ipam)
+
+
+def network_exists(name):
+    # the name filter also matches partial names (e.g. "shogun1-juice-shop_default"), so compare the names exactly
+    return any(network.name == name for network in client.networks.list(names=[name]))
+
+
+def get_shared_services_network(lab_id):
+    return f"{SHARED_NETWORK_NAME}_{lab_id}_services"
+
+
+def ensure_shared_services_network(lab_id):
+    """
+    Creates the network for the lab's shared services if it doesn't already exist. It is separate from the shared
+    network so the shared services stay reachable when inter-container communication is disabled there, and only the
+    services that connect to a shared service join it.
+    """
+    name = get_shared_services_network(lab_id)
+    if not network_exists(name):
+        print(f"Creating shared services network {name}")
+        client.networks.create(name, driver='bridge', labels={'shogun_shared_lab': lab_id})
+
+
+def allocate_shared_network_address(reserved):
+    """
+    Returns a free address on the shared network outside the dynamic range, for a service that needs a fixed address.
+
+    :param reserved: Addresses already allocated but not yet used by a container or route
+    """
+    network = client.networks.get(SHARED_NETWORK_NAME)
+    ipam_config = network.attrs['IPAM']['Config'] or []
+    if not any(pool.get('Subnet') == SHARED_NETWORK_SUBNET for pool in ipam_config):
+        raise ValueError(f"Shared network {SHARED_NETWORK_NAME} doesn't use subnet {SHARED_NETWORK_SUBNET}. Remove the "
+                         f"network or set network.subnet to its subnet.")
+
+    in_use = set(reserved)
+    in_use.update(server.target_ip for server in nginx.servers)
+    in_use.update(container['IPv4Address'].split('/')[0] for container in (network.attrs['Containers'] or {}).values())
+    in_use.update(pool['Gateway'] for pool in ipam_config if pool.get('Gateway'))
+    dynamic_range = ipaddress.ip_network(SHARED_NETWORK_DYNAMIC_RANGE)
+
+    for address in ipaddress.ip_network(SHARED_NETWORK_SUBNET).hosts():
+        if address not in dynamic_range and str(address) not in in_use:
+            return str(address)
+    raise ValueError(f"No free addresses left on shared network {SHARED_NETWORK_NAME}")
+
+
+def attach_shared_network(compose_config, project_name, route_ports):
+    """
+    Removes the port mappings for the given route ports and attaches the services that serve them to the shared
+    network. Other services are left off the shared network, and all services stay on the project's default network
+    so links between them keep working.
+
+    :param compose_config: The rendered compose config, modified in place
+    :param project_name: The compose project name, used to build a unique network alias for each service
+    :param route_ports: The placeholder host ports rendered into the template for each route
+    :return: A dictionary mapping each route port to a (container port, route target) tuple. The target is the fixed
+             address of the service when the network target is "ip", otherwise its network alias.
+    """
+    route_ports = {str(port) for port in route_ports}
+    route_services = {}
+    targets = {}
+    addresses = []
+
+    for service_name, service in compose_config.get('services', {}).items():
+        alias = f"{project_name}_{service_name}"
+
+        remaining_ports = []
+        for port_mapping in service.get('ports', []):
+            if isinstance(port_mapping, dict):
+                host_port, container_port = str(port_mapping.get('published')), str(port_mapping.get('target'))
+            else:
+                # short syntax is "[ip:]host_port:container_port[/protocol]"
+                parts = str(port_mapping).split('/')[0].split(':')
+                host_port, container_port = (parts[-2], parts[-1]) if len(parts) > 1 else (None, parts[0])
+
+            if host_port in route_ports:
+                route_services[int(host_port)] = (service_name, int(container_port))
+            else:
+                remaining_ports.append(port_mapping)
+
+        if remaining_ports:
+            service['ports'] = remaining_ports
+        else:
+            service.pop('ports', None)
+
+        if not any(route_service[0] == service_name for route_service in route_services.values()):
+            continue
+        network_settings = {'aliases': [alias]}
+        target = alias
+        if SHARED_NETWORK_TARGET == 'ip':
+            target = allocate_shared_network_address(addresses)
+            addresses.append(target)
+            network_settings['ipv4_address'] = target
+        add_service_network(service, SHARED_NETWORK_NAME, network_settings)
+        targets[service_name] = target
+
+    missing_ports = route_ports - {str(port) for port in route_services}
+    if missing_ports:
+        raise ValueError(f"Could not find port mappings for route ports {', '.join(sorted(missing_ports))}")
+
+    compose_config.setdefault('networks', {})
+    # the network name is used as the key because the "name" setting requires compose file format 3.5
+    compose_config['networks'][SHARED_NETWORK_NAME] = {'external': True}
+    return {port: (container_port, targets[service_name])
+            for port, (service_name, container_port) in route_services.items()}
+
+
+def attach_shared_services_network(compose_config, network, shared_variables):
+    """
+    Attaches the services that use the shared service template variables to the lab's shared services network.
+
+    :param compose_config: The rendered compose config, modified in place
+    :param network: The name of the lab's shared services network
+    :param shared_variables: The template variables returned by the shared services for the student
+    """
+    # the ports are the same for every student, the host names, tenant names and passwords identify the services that
+    # connect to a shared service
+    values = [value for value in shared_variables.values() if isinstance(value, str)]
+    for service in compose_config.get('services', {}).values():
+        service_config = json.dumps(service, default=str)
+        if any(value in service_config for value in values):
+            add_service_network(service, network)
+
+    compose_config.setdefault('networks', {})
+    compose_config['networks'][network] = {'external': True}
+
+
+def add_service_network(service, network, network_settings=None):
+    """
+    Adds a network to a compose service, keeping it on the project's default network if it had no networks set.
+    """
+    networks = service.get('networks') or ['default']
+    if isinstance(networks, list):
+        networks = {service_network: None for service_network in networks}
+    networks[network] = network_settings
+    service['networks'] = networks
+
+
 def find_lab_config(lab_id):
     # find the lab config for the specified lab_id
     lab_config = None
@@ -108,8 +313,8 @@ def find_lab_config(lab_id):
 def multi_create_student_container(student_id, lab_id, count, start=1, norestart=False):
     for idx in range(start, start + count):
         student_id_current = f"{student_id}{idx}"
-        create_student_container(student_id_current, lab_id, norestart=True, save=False)  # don't restart while looping.
-    nginx.save()
+        # don't restart while looping, but save the routes of each lab so gc doesn't see its containers as orphans
+        create_student_container(student_id_current, lab_id, norestart=True)
     nginx.reload(norestart=norestart)
 
 
@@ -117,14 +322,15 @@ def multi_create_student_container(student_id, lab_id, count, start=1, norestart
 # all containers for the student are deleted.
 def delete_student_container(student_id, lab_id, norestart=False):
     servers_to_delete = []
-    unique_containers_to_delete = set()  # Track unique containers
+    unique_containers_to_delete = {}  # Track unique containers and their student and lab IDs
     for server in nginx.servers:
         try:
             # check if the server matches the student_id and lab_id, use fnmatch for wildcard support
             if fnmatch(server.student_id, student_id):  # Updated condition
                 if fnmatch(server.lab_id, lab_id):  # Updated condition
                     servers_to_delete.append(server)
-                    unique_containers_to_delete.add(f"{server.student_id}-{server.lab_id}")  # Add to unique container set
+                    unique_containers_to_delete[f"{server.student_id}-{server.lab_id}"] = (server.student_id,
+                                                                                           server.lab_id)
         except IndexError:
             # Skip server if it doesn't have the expected naming format
             continue
@@ -132,7 +338,7 @@ def delete_student_container(student_id, lab_id, norestart=False):
     for server in servers_to_delete:
         nginx.remove_server(server.name)
 
-    for container_name in unique_containers_to_delete:
+    for container_name, (container_student_id, container_lab_id) in unique_containers_to_delete.items():
 
         # Get the directory where compose.py is located
         compose_dir = os.path.dirname(os.path.abspath(__file__))
@@ -161,10 +367,29 @@ def delete_student_container(student_id, lab_id, norestart=False):
         elif os.path.exists(tmp_file_path):
             os.remove(tmp_file_path)
 
+        deprovision_shared_services(container_student_id, container_lab_id)
+
     nginx.save()
     nginx.reload(norestart=norestart)
 
 
+def deprovision_shared_services(student_id, lab_id):
+    """
+    Drops the student's tenants from the lab's shared services. Failures are only logged, so the remaining labs and
+    routes are still cleaned up, and gc can drop the tenants later.
+    """
+    try:
+        lab_config = find_lab_config(lab_id)
+        shared_services = load_shared_services(client, lab_id, lab_config, get_shared_services_network(lab_id))
+    except ValueError:
+        return
+    for shared_service in shared_services:
+        try:
+            shared_service.deprovision(student_id)
+        except (docker.errors.APIError, ValueError) as e:
+            print(f"Failed to drop the tenant of {student_id} on shared service {shared_service.container_name}: {e}")
+
+
 def list_available_labs():
     lab_configs_path = 'lab_configs'
     labs = [f[:-5] for f in os.listdir(lab_configs_path) if f.endswith('.yaml')]
@@ -0,0 +1,252 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import docker
+
+from compose import client, nginx, find_lab_config, get_shared_services_network, deprovision_shared_services
+from lab_config import config
+from shared_services import load_shared_services
+
+COMPOSE_PROJECT_LABEL = 'com.docker.compose.project'
+COMPOSE_FILE_SUFFIX = '-docker-compose.yaml'
+DEFAULT_GRACE_MINUTES = 15
+
+# Get the directory where garbage_collector.py is located
+garbage_collector_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Get the tmp directory in the parent directory, where the rendered compose files are stored
+tmp_dir = os.path.join(os.path.dirname(garbage_collector_dir), 'tmp')
+
+
+def normalize_project_name(name):
+    """
+    Normalize a compose project name the same way docker-compose does, so that names from routes, compose files and
+    docker labels can be compared.
+    """
+    return re.sub(r'[^-_a-z0-9]', '', name.lower())
+
+
+def parse_docker_time(value):
+    """
+    Convert a docker timestamp (RFC 3339, with up to nanosecond precision) to seconds since the epoch.
+    """
+    # second precision is enough for the grace period, and fromisoformat only accepts "Z" from Python 3.11 on
+    value = re.sub(r'\.\d+', '', value).replace('Z', '+00:00')
+    return datetime.fromisoformat(value).timestamp()
+
+
+def load_shared_service(container):
+    """
+    Return the shared service object for a shared service container, or None if its lab or service is no longer in
+    the config.
+    """
+    lab_id = container.labels['shogun_shared_lab']
+    try:
+        lab_config = find_lab_config(lab_id)
+    except ValueError:
+        return None
+    for shared_service in load_shared_services(client, lab_id, lab_config, get_shared_services_network(lab_id)):
+        if shared_service.name == container.labels.get('shogun_shared_service'):
+            return shared_service
+    return None
+
+
+def list_tenants(shared_service):
+    """
+    Return the tenants of a shared service, or None if they can't be listed.
+    """
+    try:
+        return shared_service.list_tenants()
+    except (docker.errors.APIError, ValueError) as e:
+        print(f"Skipping tenants of shared service {shared_service.container_name}: {e}")
+        return None
+
+
+def find_orphans(include_dangling=False, grace=DEFAULT_GRACE_MINUTES):
+    """
+    Cross-reference the nginx routes, the rendered compose files and the docker resources of the student labs.
+
+    :param include_dangling: Also include dangling anonymous volumes, which may not belong to Shogun
+    :param grace: Resources created less than this many minutes ago are never orphans
+    :return: A dictionary of orphaned resources by type
+    """
+    # Labs that are still being created have containers, compose files and tenants, but no routes until all their
+    # containers are up, so anything newer than the grace period is treated as live.
+    cutoff = time.time() - grace * 60
+
+    route_projects = {}
+    for server in nginx.servers:
+        route_projects.setdefault(normalize_project_name(f"{server.student_id}-{server.lab_id}"), []).append(server)
+
+    # Containers belong to a lab if they carry the lab_id label (not every service in a template does) or are part of
+    # a compose project that does.
+    containers = client.containers.list(all=True)
+    container_projects = {}
+    for container in containers:
+        project = container.labels.get(COMPOSE_PROJECT_LABEL)
+        if project is None and 'lab_id' in container.labels and 'student_id' in container.labels:
+            project = f"{container.labels['student_id']}-{container.labels['lab_id']}"
+        if project is not None:
+            container_projects.setdefault(normalize_project_name(project), []).append(container)
+
+    compose_files = {}
+    if os.path.exists(tmp_dir):
+        for file_name in sorted(os.listdir(tmp_dir)):
+            if file_name.endswith(COMPOSE_FILE_SUFFIX):
+                project = normalize_project_name(file_name[:-len(COMPOSE_FILE_SUFFIX)])
+                compose_files[project] = os.path.join(tmp_dir, file_name)
+
+    networks = [(normalize_project_name(network.attrs['Labels'][COMPOSE_PROJECT_LABEL]), network)
+                for network in client.networks.list(filters={'label': COMPOSE_PROJECT_LABEL})]
+    volumes = [(normalize_project_name(volume.attrs['Labels'][COMPOSE_PROJECT_LABEL]), volume)
+               for volume in client.volumes.list(filters={'label': COMPOSE_PROJECT_LABEL})]
+
+    # Only projects Shogun created are collected: one of their containers carries the lab_id label, or their compose
+    # file was rendered into tmp/.
+    lab_projects = {project for project, project_containers in container_projects.items()
+                    if any('lab_id' in container.labels for container in project_containers)}
+    lab_projects.update(compose_files)
+
+    recent_projects = {project for project, project_containers in container_projects.items()
+                       if any(parse_docker_time(container.attrs['Created']) > cutoff
+                              for container in project_containers)}
+    recent_projects.update(project for project, path in compose_files.items() if os.path.getmtime(path) > cutoff)
+    recent_projects.update(project for project, network in networks
+                           if parse_docker_time(network.attrs['Created']) > cutoff)
+    recent_projects.update(project for project, volume in volumes
+                           if parse_docker_time(volume.attrs['CreatedAt']) > cutoff)
+
+    # A student lab is live if it has both routes and containers, or was created within the grace period
+    live_projects = (set(route_projects) & set(container_projects)) | recent_projects
+
+    def is_orphan_project(project):
+        return project in lab_projects and project not in live_projects
+
+    orphans = {'routes': [], 'containers': [], 'tenants': [], 'shared_services': [], 'networks': [], 'volumes': [],
+               'compose_files': []}
+    orphans['routes'] = [server for project, servers in route_projects.items() if project not in container_projects
+                         for server in servers]
+    orphans['containers'] = [container for project, project_containers in container_projects.items()
+                             if is_orphan_project(project) for container in project_containers]
+    orphans['networks'] = [network for project, network in networks if is_orphan_project(project)]
+    orphans['volumes'] = [volume for project, volume in volumes if is_orphan_project(project)]
+    if include_dangling:
+        orphans['volumes'].extend(volume for volume in client.volumes.list(filters={'dangling': True})
+                                  if not volume.attrs.get('Labels'))
+    orphans['compose_files'] = [path for project, path in compose_files.items() if project not in live_projects]
+
+    # The students of each lab whose tenants in the lab's shared services are still in use
+    live_students = {}
+    for project in live_projects & set(route_projects):
+        for server in route_projects[project]:
+            live_students.setdefault(server.lab_id, set()).add(server.student_id)
+    for project in recent_projects & set(container_projects):
+        for container in container_projects[project]:
+            if 'lab_id' in container.labels and 'student_id' in container.labels:
+                live_students.setdefault(container.labels['lab_id'], set()).add(container.labels['student_id'])
+
+    # Shared service containers are orphaned once their lab has no live students and no recently provisioned tenants
+    live_shared_labs = set()
+    for container in client.containers.list(all=True, filters={'label': 'shogun_shared_lab'}):
+        lab_id = container.labels['shogun_shared_lab']
+        shared_service = load_shared_service(container) if container.status == 'running' else None
+        tenants = list_tenants(shared_service) if shared_service is not None else None
+        recent = (parse_docker_time(container.attrs['Created']) > cutoff
+                  or any(provisioned > cutoff for provisioned in (tenants or {}).values()))
+
+        if lab_id not in live_students and not recent:
+            orphans['shared_services'].append(container)
+            continue
+        live_shared_labs.add(lab_id)
+        if tenants is None:
+            continue
+        # Failed creates can leave behind tenants without containers or routes
+        live_tenants = {shared_service.get_tenant_name(student_id) for student_id in live_students.get(lab_id, ())}
+        orphans['tenants'].extend((shared_service, tenant) for tenant, provisioned in sorted(tenants.items())
+                                  if tenant not in live_tenants and provisioned <= cutoff)
+
+    orphans['networks'].extend(network for network in client.networks.list(filters={'label': 'shogun_shared_lab'})
+                               if network.attrs['Labels']['shogun_shared_lab'] not in live_shared_labs
+                               and parse_docker_time(network.attrs['Created']) <= cutoff)
+    return orphans
+
+
+def describe_orphan(orphan_type, orphan):
+    if orphan_type == 'routes':
+        return orphan.print_route_map()
+    elif orphan_type == 'tenants':
+        shared_service, tenant = orphan
+        return f"{tenant} on {shared_service.container_name}"
+    elif orphan_type == 'compose_files':
+        return orphan
+    return orphan.name
+
+
+def remove_orphan(orphan_type, orphan):
+    """
+    Remove a single orphaned docker resource or compose file. Returns True if it was removed.
+    """
+    try:
+        if orphan_type == 'tenants':
+            shared_service, tenant = orphan
+            shared_service.drop_tenant(tenant)
+        elif orphan_type in ('containers', 'shared_services'):
+            # v=True also removes the container's anonymous volumes
+            orphan.remove(force=True, v=True)
+        elif orphan_type == 'compose_files':
+            os.remove(orphan)
+        else:
+            orphan.remove()
+    except (docker.errors.APIError, OSError, ValueError) as e:
+        print(f"Failed to remove {orphan_type[:-1].replace('_', ' ')} {describe_orphan(orphan_type, orphan)}: {e}")
+        return False
+    print(f"Removed {orphan_type[:-1].replace('_', ' ')} {describe_orphan(orphan_type, orphan)}")
+    return True
+
+
+def remove_stale_routes(servers):
+    """
+    Remove routes whose containers are gone and drop the students' tenants from the lab's shared services.
+    """
+    for server in servers:
+        nginx.remove_server(server.name)
+
+    # failures are logged per student, so one broken shared service doesn't stop the rest of the collection
+    for student_id, lab_id in {(server.student_id, server.lab_id) for server in servers}:
+        deprovision_shared_services(student_id, lab_id)
+
+
+def collect_garbage(dry_run=False, workers=8, norestart=False, include_dangling=False, grace=DEFAULT_GRACE_MINUTES):
+    """
+    Find orphaned lab resources and remove them. Docker resources are removed in parallel.
+
+    :param dry_run: Only list the orphaned resources
+    :param workers: The number of resources to remove in parallel
+    :param norestart: Do not reload nginx after removing stale routes
+    :param include_dangling: Also remove dangling anonymous volumes, which may not belong to Shogun
+    :param grace: Resources created less than this many minutes ago are never removed
+    :return: A dictionary of orphaned resources by type
+    """
+    orphans = find_orphans(include_dangling, grace)
+
+    for orphan_type, type_orphans in orphans.items():
+        for orphan in type_orphans:
+            action = "Would remove" if dry_run else "Found orphaned"
+            print(f"{action} {orphan_type[:-1].replace('_', ' ')}: {describe_orphan(orphan_type, orphan)}")
+    if dry_run or not any(orphans.values()):
+        return orphans
+
+    if orphans['routes']:
+        remove_stale_routes(orphans['routes'])
+        nginx.save()
+        nginx.reload(norestart=norestart)
+
+    # Containers must be removed before the networks and volumes they use
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for phase in (('containers', 'tenants', 'shared_services'), ('networks', 'volumes', 'compose_files')):
+            list(executor.map(lambda item: remove_orphan(*item),
+                              [(orphan_type, orphan) for orphan_type in phase for orphan in orphans[orphan_type]]))
+    return orphans
@@ -1,20 +1,129 @@
+import ipaddress
 import os
+import re
 
 from dotenv import load_dotenv
 
 from certificate_providers import NoneProvider, SelfSignedProvider
+from lab_config import config
 
 load_dotenv()
 
 NGINX_CONF_DIR = os.environ.get('NGINX_CONF_DIR', '/etc/nginx/')
 NGINX_CONFIG_PATH = os.path.join(os.path.dirname(NGINX_CONF_DIR), 'shogun.conf')
 
+# Port that server blocks serve HTTPS on when a certificate provider is configured
+HTTPS_PORT = 443
+
 # Environment variable for selecting the certificate provider
 CERT_PROVIDER_ENV = os.environ.get('CERT_PROVIDER', 'NONE').upper()
 
 # Add this line at the beginning of the file to load the custom header value
 CUSTOM_HEADER_VALUE = os.environ.get('X_SAMURAIWTF', None)
 
+# DNS resolver used for routes that target a container name instead of an IP address. Defaults to Docker's embedded DNS
+# server, which is available when nginx runs in a container attached to the same network as the labs.
+NGINX_RESOLVER = os.environ.get('NGINX_RESOLVER', '127.0.0.11')
+
+# Directory and maximum size of the shared proxy cache used by labs with the static_cache feature enabled
+NGINX_CACHE_DIR = os.environ.get('NGINX_CACHE_DIR', '/var/cache/nginx/shogun')
+NGINX_CACHE_MAX_SIZE = os.environ.get('NGINX_CACHE_MAX_SIZE', '1g')
+
+# Name of the proxy cache zone shared by all server blocks. The cache key includes the host, so every route (and
+# therefore every student) gets its own cache entries even though the zone is shared.
+STATIC_CACHE_ZONE = 'shogun_static'
+
+# File extensions cached when the static_cache feature is enabled without an explicit list of extensions
+DEFAULT_STATIC_EXTENSIONS = ['js', 'css', 'map', 'png', 'jpg', 'jpeg', 'gif', 'svg', 'ico', 'woff', 'woff2', 'ttf']
+DEFAULT_STATIC_CACHE_VALID = '1h'
+
+# Content types compressed when the gzip feature is enabled (text/html is always compressed by nginx)
+GZIP_TYPES = ['text/plain', 'text/css', 'text/javascript', 'application/javascript', 'application/json',
+              'application/xml', 'image/svg+xml']
+
+
+def static_cache_features(static_cache):
+    """
+    Converts the static_cache lab feature into feature strings that can be stored in the server metadata.
+
+    The feature may be set to true to cache the default static file extensions, or to a mapping with optional
+    "extensions", "prefixes" and "valid" keys.
+    """
+    if not isinstance(static_cache, dict):
+        static_cache = {}
+
+    extensions = static_cache.get('extensions')
+    prefixes = static_cache.get('prefixes', [])
+    if extensions is None and not prefixes:
+        extensions = DEFAULT_STATIC_EXTENSIONS
+    valid = str(static_cache.get('valid', DEFAULT_STATIC_CACHE_VALID))
+
+    extensions = [str(ext).lstrip('.') for ext in extensions or []]
+    prefixes = [str(prefix) for prefix in prefixes]
+
+    # The values are written into location and proxy_cache_valid directives and the metadata comment (which uses "|",
+    # "," and ";" as separators), so only allow characters that are safe in all of them.
+    invalid_values = [ext for ext in extensions if not re.fullmatch(r'[A-Za-z0-9]+', ext)]
+    invalid_values += [prefix for prefix in prefixes if not re.fullmatch(r'/[A-Za-z0-9._~/-]*', prefix)]
+    if not re.fullmatch(r'([0-9]+[smhdwMy]?)+', valid):
+        invalid_values.append(valid)
+    if invalid_values:
+        raise ValueError(f"Invalid static_cache setting(s) {', '.join(invalid_values)} in {static_cache}")
+
+    feature_list = []
+    if extensions:
+        feature_list.append(f"cache_ext={';'.join(extensions)}")
+    if prefixes:
+        feature_list.append(f"cache_prefix={';'.join(prefixes)}")
+    feature_list.append(f"cache_valid={valid}")
+    return feature_list
+
+
+# Default TLS profile for HTTPS server blocks. Any of these settings can be overridden by a "tls" section in the config
+# file. http2 may be true (adds http2 to the listen directive), "directive" (emits "http2 on;", nginx 1.25.1+) or false.
+DEFAULT_TLS_PROFILE = {
+    'protocols': ['TLSv1.2', 'TLSv1.3'],
+    'http2': True,
+    'session_cache': '10m',
+    'session_timeout': '1d',
+    'session_tickets': True,
+    'session_ticket_key': None,
+    'prefer_server_ciphers': False,
+}
+
+
+def load_tls_profile():
+    """
+    Loads the TLS profile from the config file, falling back to the defaults for any unspecified settings.
+    """
+    tls_profile = dict(DEFAULT_TLS_PROFILE)
+    tls_profile.update(config.get('tls') or {})
+
+    if tls_profile['http2'] not in (True, False, 'directive'):
+        raise ValueError(f"Unsupported tls http2 setting: {tls_profile['http2']}")
+    if isinstance(tls_profile['protocols'], str):
+        tls_profile['protocols'] = tls_profile['protocols'].split()
+    return tls_profile
+
+
+def generate_tls_directives(tls_profile):
+    """
+    Returns the http-level nginx directives for the given TLS profile. These apply to every HTTPS server block, so the
+    session cache is shared by all labs and their per-lab wildcard certificates.
+    """
+    directives = [f"ssl_protocols {' '.join(tls_profile['protocols'])};",
+                  f"ssl_prefer_server_ciphers {'on' if tls_profile['prefer_server_ciphers'] else 'off'};"]
+    if tls_profile['session_cache']:
+        directives.append(f"ssl_session_cache shared:shogun_ssl:{tls_profile['session_cache']};")
+    directives.append(f"ssl_session_timeout {tls_profile['session_timeout']};")
+    directives.append(f"ssl_session_tickets {'on' if tls_profile['session_tickets'] else 'off'};")
+    # Without a ticket key file nginx generates new keys on every reload, invalidating all issued tickets
+    if tls_profile['session_tickets'] and tls_profile['session_ticket_key']:
+        directives.append(f"ssl_session_ticket_key {tls_profile['session_ticket_key']};")
+    if tls_profile['http2'] == 'directive':
+        directives.append("http2 on;")
+    return directives
+
 
 def load_certificate_provider():
     """
@@ -31,10 +140,12 @@ def load_certificate_provider():
 class ShogunServer:
     def __init__(self, student_id, subdomain, lab_id, domain, target_ip, target_port, listen_ports=None, features=[]):
         self.certificate_provider = load_certificate_provider()
+        self.tls_profile = load_tls_profile()
+        self.https_port = HTTPS_PORT
         if listen_ports is None:
             # If no listen ports are specified, default to 80 and 443 if the NoneProvider is not used
             if not isinstance(self.certificate_provider, NoneProvider):
-                listen_ports = [443, 80]
+                listen_ports = [self.https_port, 80]
             else:
                 listen_ports = [80]
         self.name = f"{student_id}.{subdomain}.{lab_id}.{domain}" if subdomain != 'main' else f"{student_id}.{lab_id}.{domain}"
@@ -51,9 +162,7 @@ class ShogunServer:
     # Generate a single metadata comment for simply parsing the config to retrieve the servers from the nginx config
     # The format will be "# METADATA:student_id|subdomain|lab_id|domain|target_ip|target_port|listen_ports"
     def _generate_metadata(self):
-        # the ports are stored as strings and may include 'ssl' if the certificate provider is not NoneProvider.
-        # For the metadata we need to remove the 'ssl' string so that it can be parsed as an integer
-        listen_ports= ",".join([port.replace("ssl", "") for port in self.listen_ports])
+        listen_ports = ",".join(self.listen_ports)
         features_string = ",".join(self.features)
         return f"# METADATA:{self.student_id}|{self.subdomain}|{self.lab_id}|{self.domain}|{self.target_ip}|{self.target_port}|{listen_ports}|{features_string}"
 
@@ -71,6 +180,22 @@ class ShogunServer:
         return cls(metadata[0], metadata[1], metadata[2], metadata[3], metadata[4], metadata[5],
                    [int(port) for port in metadata[6].split(",")], features_list)
 
+    # Returns the value of a "name=value" feature, or None if the feature is not set
+    def _get_feature_value(self, name):
+        prefix = f"{name}="
+        return next((feature[len(prefix):] for feature in self.features if feature.startswith(prefix)), None)
+
+    # Returns True if the route targets a host name (e.g. a container on a shared network) rather than an IP address
+    def has_hostname_target(self):
+        try:
+            ipaddress.ip_address(self.target_ip)
+            return False
+        except ValueError:
+            return True
+
+    def has_static_cache(self):
+        return self._get_feature_value('cache_valid') is not None
+
     # Convenience method to print the route map (e.g. "student_id.subdomain.lab_id.domain -> target_ip:target_port")
     def print_route_map(self):
         return f"{self.name} -> {self.target_ip}:{self.target_port}"
@@ -78,17 +203,21 @@ class ShogunServer:
     def generate_raw_block(self):
         cert_path, key_path = self.certificate_provider.get_certificate_paths(self.lab_id)
         ssl_config = ""
+        listen_ports = list(self.listen_ports)
+        https_port = str(self.https_port)
 
-        if "443" in self.listen_ports and not isinstance(self.certificate_provider, NoneProvider):
+        # The TLS profile (protocols, session cache, etc.) is emitted once at the http level by NginxConfig, so only the
+        # per-lab wildcard certificate is configured here.
+        if https_port in listen_ports and not isinstance(self.certificate_provider, NoneProvider):
             ssl_config = f"""
     ssl_certificate     {cert_path};
-    ssl_certificate_key {key_path};                
-    ssl_prefer_server_ciphers off;
+    ssl_certificate_key {key_path};
                 """
-            # append ssl to the 443 listen port (e.g. "listen 443 ssl;")
-            self.listen_ports[self.listen_ports.index("443")] = f"443 ssl"
+            # append ssl to the https listen port (e.g. "listen 443 ssl;")
+            ssl_options = "ssl http2" if self.tls_profile['http2'] is True else "ssl"
+            listen_ports[listen_ports.index(https_port)] = f"{https_port} {ssl_options}"
 
-        listen_port_str = "\n".join(f"    listen {port};" for port in self.listen_ports)
+        listen_port_str = "\n".join(f"    listen {port};" for port in listen_ports)
 
         # Make a custom header check (X-SAMURAIWTF) if the environment variable is set. This header is a security
         # measure to prevent the server from being accessed directly by the IP address.
@@ -108,29 +237,87 @@ class ShogunServer:
         proxy_set_header Connection "upgrade";
             """
 
+        # With gzip enabled nginx compresses responses itself, so ask the lab container for uncompressed content to
+        # keep the compression work (and the cached copies) out of the container.
+        gzip_config = ""
+        accept_encoding = ""
+        if "gzip" in self.features:
+            gzip_config = f"""
+    gzip on;
+    gzip_proxied any;
+    gzip_vary on;
+    gzip_comp_level 5;
+    gzip_min_length 1024;
+    gzip_types {' '.join(GZIP_TYPES)};
+            """
+            accept_encoding = """
+        proxy_set_header Accept-Encoding "";"""
+
+        # Host names in proxy_pass are resolved when the config is loaded, so a single missing container would make the
+        # whole config fail to load. Proxying through a variable makes nginx resolve the name per request instead.
+        upstream_config = ""
+        proxy_pass = f"http://{self.target_ip}:{self.target_port}"
+        if self.has_hostname_target():
+            upstream_config = f"""
+    set $shogun_upstream {proxy_pass};"""
+            proxy_pass = "$shogun_upstream"
+
+        proxy_config = f"""{custom_header}
+        proxy_pass {proxy_pass};
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;{accept_encoding}"""
+
+        # Static assets are cached in the shared zone defined once by NginxConfig. The cache key includes the host so
+        # that cached content is never shared between routes (and therefore between students). Lab servers often send
+        # "Cache-Control: max-age=0" for their assets (e.g. the express.static default), which would prevent caching,
+        # so the configured validity overrides the upstream's cache headers.
+        static_locations = ""
+        if self.has_static_cache():
+            cache_config = f"""
+        proxy_cache {STATIC_CACHE_ZONE};
+        proxy_cache_key "$scheme$host$request_uri";
+        proxy_ignore_headers Cache-Control Expires;
+        proxy_cache_valid 200 301 302 {self._get_feature_value('cache_valid')};
+        proxy_cache_lock on;
+        proxy_cache_use_stale error timeout updating;
+        add_header X-Cache-Status $upstream_cache_status;"""
+
+            static_matchers = []
+            extensions = self._get_feature_value('cache_ext')
+            if extensions:
+                static_matchers.append(f"~* \\.({'|'.join(extensions.split(';'))})$")
+            prefixes = self._get_feature_value('cache_prefix')
+            if prefixes:
+                static_matchers.extend(f"^~ {prefix}" for prefix in prefixes.split(';'))
+
+            static_locations = "".join(f"""
+    location {matcher} {{
+        {proxy_config}{cache_config}
+    }}
+""" for matcher in static_matchers)
 
         return f"""{self._generate_metadata()}
 server {{
 {ssl_config}
 {listen_port_str}
-    server_name {self.name};
-    
+    server_name {self.name};{upstream_config}
+{gzip_config}
     location / {{
-        {custom_header}
-        proxy_pass http://{self.target_ip}:{self.target_port};
-        proxy_set_header Host $host;
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        {proxy_config}
 {websocket_support}
     }}
-}}"""
+{static_locations}}}"""
 
 
 class NginxConfig:
     servers: list[ShogunServer]
 
-    def __init__(self, config_path=NGINX_CONFIG_PATH):
+    def __init__(self, config_path=NGINX_CONFIG_PATH, cache_dir=NGINX_CACHE_DIR):
         self.config_path = config_path
+        self.cache_dir = cache_dir
+        self.certificate_provider = load_certificate_provider()
+        self.tls_profile = load_tls_profile()
         self.in_use_ports = set()
 
         if not os.path.exists(config_path):
@@ -162,7 +349,8 @@ class NginxConfig:
                     metadata_line = block.split('\n')[0]
                     shogun_server = ShogunServer.from_metadata(metadata_line)
                     servers.append(shogun_server)
-                    self.in_use_ports.add(shogun_server.target_port)
+                    if shogun_server.target_ip == '127.0.0.1':
+                        self.in_use_ports.add(int(shogun_server.target_port))
             return servers
 
     def add_server(self, student_id, lab_id, subdomain, domain, target_port, listen_ports=None, target_ip='127.0.0.1',
@@ -172,26 +360,53 @@ class NginxConfig:
         if features:
             if features.get('websockets', False):
                 feature_list.append('ws')
+            if features.get('gzip', False):
+                feature_list.append('gzip')
+            if features.get('static_cache', False):
+                feature_list.extend(static_cache_features(features['static_cache']))
 
         new_server = ShogunServer(student_id, subdomain, lab_id, domain, target_ip, target_port, listen_ports,
                                   feature_list)
 
         if not any(server.name == new_server.name for server in self.servers):
             self.servers.append(new_server)
-            self.in_use_ports.add(target_port)
+            # Only host-published ports are tracked. Routes to containers on a shared network use container ports,
+            # which may be the same for many routes.
+            if target_ip == '127.0.0.1':
+                self.in_use_ports.add(int(target_port))
             print(f"Added new server: {new_server.print_route_map()}")
 
     def remove_server(self, server_name):
         # remove the server's port from the in_use_ports set
         server = next((server for server in self.servers if server.name == server_name), None)
         if server:
-            self.in_use_ports.remove(server.target_port)
+            self.in_use_ports.discard(int(server.target_port))
             print(f"Removed server: {server.print_route_map()}")
             # remove the server from the servers list
             self.servers.remove(server)
 
+    # Generate the http-level directives shared by all server blocks. These are written once at the top of the config
+    # file instead of being repeated in every server block. Returns an empty string if no shared directives are needed.
+    def generate_http_block(self):
+        directives = []
+        if not isinstance(self.certificate_provider, NoneProvider):
+            directives.extend(generate_tls_directives(self.tls_profile))
+        if any(server.has_hostname_target() for server in self.servers):
+            directives.append(f"resolver {NGINX_RESOLVER} valid=10s;")
+        if any(server.has_static_cache() for server in self.servers):
+            directives.append(f"proxy_cache_path {self.cache_dir} levels=1:2 keys_zone={STATIC_CACHE_ZONE}:10m "
+                              f"max_size={NGINX_CACHE_MAX_SIZE} inactive=1d use_temp_path=off;")
+
+        if not directives:
+            return ""
+        return "# Shared settings for all Shogun lab server blocks\n" + "\n".join(directives)
+
     def save(self):
-        updated_config = '\n\n'.join([server.generate_raw_block() for server in self.servers])
+        blocks = [server.generate_raw_block() for server in self.servers]
+        http_block = self.generate_http_block()
+        if http_block:
+            blocks.insert(0, http_block)
+        updated_config = '\n\n'.join(blocks)
         print(f"Saving nginx config to {self.config_path}.")
 
         with open(self.config_path, 'w') as file:
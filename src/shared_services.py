@@ -0,0 +1,241 @@
+import hashlib
+import io
+import os
+import re
+import secrets
+import tarfile
+import time
+from abc import ABC, abstractmethod
+
+import docker
+
+# Get the directory where shared_services.py is located
+shared_services_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Get the parent directory, which init_sql paths are relative to
+parent_dir = os.path.dirname(shared_services_dir)
+
+# MySQL client errors for a server that isn't accepting connections yet (CR_CONNECTION_ERROR, CR_CONN_HOST_ERROR)
+MYSQL_CONNECTION_ERRORS = r'ERROR (2002|2003) '
+
+
+class SharedService(ABC):
+    """
+    Abstract class defining the interface for services that run once per lab and are shared by all students. Each
+    student gets an isolated tenant (e.g. a database schema) within the shared service.
+    """
+
+    def __init__(self, client, lab_id: str, name: str, settings: dict, network: str):
+        """
+        :param client: The docker client
+        :param lab_id: The ID of the lab the service belongs to
+        :param name: The name of the service in the lab config, used as the prefix for template variables
+        :param settings: The service settings from the lab config
+        :param network: The shared docker network the service and the student services join
+        """
+        self.client = client
+        self.lab_id = lab_id
+        self.name = name
+        self.settings = settings
+        self.network = network
+        if not re.fullmatch(r'[A-Za-z0-9_]+', name):
+            raise ValueError(f"Invalid shared service name: {name}")
+        self.container_name = f"shogun_{lab_id}_{name}"
+
+    @abstractmethod
+    def ensure_running(self):
+        """
+        Starts the shared service container if it isn't already running.
+        """
+        pass
+
+    @abstractmethod
+    def get_tenant_name(self, student_id: str) -> str:
+        """
+        Returns the name of the given student's tenant.
+        """
+        pass
+
+    @abstractmethod
+    def provision(self, student_id: str) -> dict:
+        """
+        Creates the tenant for the given student and returns the template variables for the student's services.
+        """
+        pass
+
+    @abstractmethod
+    def deprovision(self, student_id: str):
+        """
+        Removes the tenant for the given student.
+        """
+        pass
+
+    @abstractmethod
+    def list_tenants(self) -> dict:
+        """
+        Returns the names of all tenants in the shared service, mapped to the time they were last provisioned.
+        """
+        pass
+
+    @abstractmethod
+    def drop_tenant(self, tenant: str):
+        """
+        Removes the tenant with the given name.
+        """
+        pass
+
+    def run_container(self, image, environment):
+        """
+        Starts the shared container on the shared network, reusing an existing container if there is one.
+        """
+        try:
+            container = self.client.containers.get(self.container_name)
+            if container.status != 'running':
+                container.start()
+            return container
+        except docker.errors.NotFound:
+            pass
+
+        print(f"Starting shared service {self.container_name}")
+        return self.client.containers.run(image, name=self.container_name, detach=True, environment=environment,
+                                          network=self.network, restart_policy={'Name': 'unless-stopped'},
+                                          labels={'shogun_shared_lab': self.lab_id,
+                                                  'shogun_shared_service': self.name})
+
+
+class MySQLSharedService(SharedService):
+    """
+    Shared MySQL (or MariaDB) server. Each student gets their own database and user with access to only that database.
+
+    Template variables: {name}_host, {name}_port, {name}_database, {name}_user and {name}_password.
+    """
+
+    def __init__(self, client, lab_id: str, name: str, settings: dict, network: str):
+        super().__init__(client, lab_id, name, settings, network)
+        self.image = settings.get('image', 'mysql:8.0')
+        self.root_password = str(settings['root_password']) if settings.get('root_password') else None
+        self.init_sql = settings.get('init_sql')
+        self.ready_timeout = settings.get('ready_timeout', 120)
+
+    def ensure_running(self):
+        # Root may only log in from inside the container (which is how execute() connects), so students' services on
+        # the shared network can't use it to reach other students' databases.
+        self.run_container(self.image, {'MYSQL_ROOT_PASSWORD': self.get_root_password(),
+                                        'MYSQL_ROOT_HOST': '127.0.0.1'})
+
+    def get_root_password(self) -> str:
+        """
+        Returns the configured root password. Otherwise the password is read from the existing container, which keeps
+        it for as long as its data exists, or a random one is generated for a new container.
+        """
+        if self.root_password is None:
+            try:
+                environment = self.client.containers.get(self.container_name).attrs['Config']['Env'] or []
+                self.root_password = next(variable.split('=', 1)[1] for variable in environment
+                                          if variable.startswith('MYSQL_ROOT_PASSWORD='))
+            except (docker.errors.NotFound, StopIteration):
+                self.root_password = secrets.token_urlsafe(24)
+        return self.root_password
+
+    def get_tenant_name(self, student_id: str) -> str:
+        # MySQL user names are limited to 32 characters and only safe identifier characters are allowed. A hash of the
+        # real IDs keeps the names unique when different IDs sanitize or truncate to the same prefix.
+        prefix = re.sub(r'[^A-Za-z0-9_]', '_', f"{self.lab_id}_{student_id}")[:23]
+        digest = hashlib.sha256(f"{self.lab_id}/{student_id}".encode()).hexdigest()[:8]
+        return f"{prefix}_{digest}"
+
+    def execute(self, sql, database=None):
+        """
+        Runs the SQL as root over TCP, which only succeeds once the server has finished initialising. Retries while the
+        server can't be connected to, until the timeout is reached. Other errors are raised immediately.
+        """
+        command = ['mysql', '--protocol=tcp', '-h127.0.0.1', '-uroot', '-N', '-e', sql]
+        if database:
+            command.append(database)
+
+        container = self.client.containers.get(self.container_name)
+        deadline = time.time() + self.ready_timeout
+        while True:
+            # pass the password through the environment to keep it out of the process list and the output
+            exit_code, (stdout, stderr) = container.exec_run(command,
+                                                             environment={'MYSQL_PWD': self.get_root_password()},
+                                                             demux=True)
+            if exit_code == 0:
+                return (stdout or b'').decode().strip()
+            error = (stderr or b'').decode().strip()
+            if not re.search(MYSQL_CONNECTION_ERRORS, error) or time.time() > deadline:
+                raise ValueError(f"Error running SQL on shared service {self.container_name}: {error}")
+            time.sleep(2)
+
+    def load_init_sql(self, database):
+        """
+        Copies the init_sql file into the container and loads it into the given database.
+        """
+        init_sql_path = os.path.join(parent_dir, self.init_sql)
+        if not os.path.exists(init_sql_path):
+            raise ValueError(f"Could not find init_sql file at {init_sql_path}")
+
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.add(init_sql_path, arcname='shogun_init.sql')
+        self.client.containers.get(self.container_name).put_archive('/tmp', archive.getvalue())
+        self.execute('source /tmp/shogun_init.sql', database)
+
+    def provision(self, student_id: str) -> dict:
+        tenant = self.get_tenant_name(student_id)
+        password = secrets.token_hex(16)
+
+        exists = self.execute(f"SELECT SCHEMA_NAME FROM information_schema.SCHEMATA WHERE SCHEMA_NAME = '{tenant}'")
+        print(f"Provisioning database {tenant} on shared service {self.container_name}")
+        self.execute(f"CREATE DATABASE IF NOT EXISTS `{tenant}`; "
+                     f"CREATE USER IF NOT EXISTS '{tenant}'@'%' IDENTIFIED BY '{password}'; "
+                     f"ALTER USER '{tenant}'@'%' IDENTIFIED BY '{password}'; "
+                     f"GRANT ALL PRIVILEGES ON `{tenant}`.* TO '{tenant}'@'%'; "
+                     f"FLUSH PRIVILEGES;")
+        if self.init_sql and not exists:
+            self.load_init_sql(tenant)
+
+        return {f"{self.name}_host": self.container_name,
+                f"{self.name}_port": 3306,
+                f"{self.name}_database": tenant,
+                f"{self.name}_user": tenant,
+                f"{self.name}_password": password}
+
+    def deprovision(self, student_id: str):
+        self.drop_tenant(self.get_tenant_name(student_id))
+
+    def list_tenants(self) -> dict:
+        # The tenant users are the only users that can log in from other hosts. Provisioning resets their password, so
+        # password_last_changed (MySQL 5.7 and later) is the time the tenant was last provisioned.
+        rows = self.execute("SELECT User, IFNULL(UNIX_TIMESTAMP(password_last_changed), 0) FROM mysql.user "
+                            "WHERE Host = '%' AND User != 'root'")
+        return {user: float(provisioned) for user, provisioned in (row.split('\t') for row in rows.splitlines())}
+
+    def drop_tenant(self, tenant: str):
+        if not re.fullmatch(r'[A-Za-z0-9_]+', tenant):
+            raise ValueError(f"Invalid tenant name: {tenant}")
+        try:
+            self.client.containers.get(self.container_name)
+        except docker.errors.NotFound:
+            # the shared service was removed, so there is nothing left to drop
+            return
+        print(f"Dropping database {tenant} on shared service {self.container_name}")
+        self.execute(f"DROP DATABASE IF EXISTS `{tenant}`; DROP USER IF EXISTS '{tenant}'@'%';")
+
+
+SHARED_SERVICE_ENGINES = {
+    'mysql': MySQLSharedService,
+}
+
+
+def load_shared_services(client, lab_id, lab_config, network):
+    """
+    Loads and returns the shared services declared in the lab config.
+    """
+    shared_services = []
+    for name, settings in (lab_config.get('shared_services') or {}).items():
+        engine = settings.get('engine', 'mysql')
+        if engine not in SHARED_SERVICE_ENGINES:
+            raise ValueError(f"Unsupported shared service engine: {engine}")
+        shared_services.append(SHARED_SERVICE_ENGINES[engine](client, lab_id, name, settings, network))
+    return shared_services